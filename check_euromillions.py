@@ -1,33 +1,102 @@
 #!/usr/bin/env python3
 import json
 import os
-import urllib.request
+import tempfile
+import urllib.error
 from datetime import datetime
+from operator import itemgetter
+
+from lottery_common import https_request, send_telegram_message
 
 EUROMILLIONS_API = "https://euromillions.api.pedromealha.dev/v1/draws"
-TELEGRAM_API = "https://api.telegram.org/bot{token}/sendMessage"
+# Per-user cache directory, so other local users cannot plant or redirect it
+DRAW_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "are-we-millionaires",
+)
+DRAW_CACHE_PATH = os.path.join(DRAW_CACHE_DIR, "euromillions_draw.json")
+
+
+def load_cached_draw(path=DRAW_CACHE_PATH):
+    """Load the cached draw entry, or None if there is no usable cache."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # Only trust a well-formed entry
+    if not isinstance(entry, dict) or not isinstance(entry.get("draw"), dict):
+        return None
+    for header in ("etag", "last_modified"):
+        if not isinstance(entry.get(header), (str, type(None))):
+            return None
+    return entry
+
+
+def save_cached_draw(entry, path=DRAW_CACHE_PATH):
+    """Atomically write the draw entry to the cache file."""
+    cache_dir = os.path.dirname(path)
+    tmp_path = None
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        # mkstemp creates a new, uniquely named file and never follows an existing one
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Warning: could not cache draw: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def fetch_latest_draw():
-    """Fetch the most recent Euromillions draw from the API."""
-    req = urllib.request.Request(EUROMILLIONS_API, headers={"User-Agent": "Mozilla/5.0"})
-    with urllib.request.urlopen(req, timeout=30) as response:
-        draws = json.loads(response.read().decode())
+    """Fetch the most recent Euromillions draw, reusing the cached one if unchanged."""
+    cache = load_cached_draw()
+
+    # Always ask the API, since a new draw may have happened since the last run,
+    # but send the cache validators so an unchanged draw list is not downloaded again
+    headers = {}
+    if cache and cache.get("etag"):
+        headers["If-None-Match"] = cache["etag"]
+    if cache and cache.get("last_modified"):
+        headers["If-Modified-Since"] = cache["last_modified"]
+
+    try:
+        response = https_request("GET", EUROMILLIONS_API, headers=headers)
+    except urllib.error.HTTPError as e:
+        # A 304 is only meaningful if we sent validators from a cached draw
+        if e.code != 304 or cache is None:
+            raise
+        e.close()
+        return cache["draw"]
+
+    with response:
+        draws = json.load(response)
+
+    draw = max(draws, key=itemgetter("date"))
+
+    save_cached_draw({
+        "draw": draw,
+        "etag": response.getheader("ETag"),
+        "last_modified": response.getheader("Last-Modified"),
+    })
+    return draw
+
 
-    # Sort by date descending and get the latest
-    draws_sorted = sorted(draws, key=lambda x: x["date"], reverse=True)
-    return draws_sorted[0]
+def _bitmask(values):
+    """Pack numbers (1-50) or stars (1-12) into an int with one bit per value."""
+    mask = 0
+    for value in values:
+        mask |= 1 << int(value)
+    return mask
 
 
 def calculate_matches(my_numbers, my_stars, winning_numbers, winning_stars):
     """Calculate how many numbers and stars match."""
-    my_numbers_set = set(my_numbers)
-    my_stars_set = set(my_stars)
-    winning_numbers_set = set(winning_numbers)
-    winning_stars_set = set(winning_stars)
-
-    matched_numbers = len(my_numbers_set & winning_numbers_set)
-    matched_stars = len(my_stars_set & winning_stars_set)
+    matched_numbers = (_bitmask(my_numbers) & _bitmask(winning_numbers)).bit_count()
+    matched_stars = (_bitmask(my_stars) & _bitmask(winning_stars)).bit_count()
 
     return matched_numbers, matched_stars
 
@@ -47,20 +116,12 @@ def format_message(draw, my_numbers, my_stars, matched_numbers, matched_stars, p
     draw_date = draw["date"]
     has_jackpot_winner = draw.get("has_winner", False)
 
-    # Create visual representation of matches
-    my_nums_display = []
-    for num in my_numbers:
-        if num in winning_numbers:
-            my_nums_display.append(f"[{num}]")  # Matched
-        else:
-            my_nums_display.append(num)
-
-    my_stars_display = []
-    for star in my_stars:
-        if star in winning_stars:
-            my_stars_display.append(f"[{star}]")  # Matched
-        else:
-            my_stars_display.append(star)
+    # Create visual representation of matches (matched values in brackets),
+    # comparing values as integers like calculate_matches does
+    winning_numbers_mask = _bitmask(winning_numbers)
+    winning_stars_mask = _bitmask(winning_stars)
+    my_nums_display = [f"[{num}]" if winning_numbers_mask >> int(num) & 1 else num for num in my_numbers]
+    my_stars_display = [f"[{star}]" if winning_stars_mask >> int(star) & 1 else star for star in my_stars]
 
     # Build message
     lines = [
@@ -80,51 +141,33 @@ def format_message(draw, my_numbers, my_stars, matched_numbers, matched_stars, p
     ]
 
     if prize_amount > 0:
-        lines.extend([
+        lines.extend((
             "",
             f"💰 *YOU WON!*",
             f"   Prize: €{prize_amount:,.2f}",
             f"   Winners in this category: {winners}",
-        ])
+        ))
 
     if matched_numbers == 5 and matched_stars == 2:
-        lines.extend([
+        lines.extend((
             "",
             "🎉🎉🎉 *JACKPOT!!! YOU ARE A MILLIONAIRE!!!* 🎉🎉🎉",
-        ])
+        ))
     else:
-        lines.extend([
+        lines.extend((
             "",
             "😢 No millions this time loosers, you are still poor",
-        ])
+        ))
 
     if has_jackpot_winner:
         lines.append(f"\nℹ️ This draw had a jackpot winner!")
-    lines.extend([
+    lines.extend((
         "❕Do not forget to check the combination for the \"The Million\" additional draw❕", 
         "Official results: https://www.loteriasyapuestas.es/es/resultados"
-    ])
+    ))
     return "\n".join(lines)
 
 
-def send_telegram_message(token, chat_id, message):
-    """Send a message via Telegram Bot API."""
-    url = TELEGRAM_API.format(token=token)
-    data = json.dumps({
-        "chat_id": chat_id,
-        "text": message,
-        "parse_mode": "Markdown"
-    }).encode("utf-8")
-
-    req = urllib.request.Request(url, data=data, headers={
-        "Content-Type": "application/json",
-        "User-Agent": "Mozilla/5.0"
-    })
-
-    with urllib.request.urlopen(req, timeout=30) as response:
-        return json.loads(response.read().decode())
-
-
 def main():
     # Get configuration from environment
     telegram_token = os.environ.get("TELEGRAM_BOT_TOKEN")
@@ -147,6 +190,12 @@ def main():
     if len(my_stars) != 2:
         print(f"Error: Expected 2 stars, got {len(my_stars)}")
         exit(1)
+    if not all(1 <= int(n) <= 50 for n in my_numbers):
+        print(f"Error: Numbers must be between 1 and 50, got {my_numbers}")
+        exit(1)
+    if not all(1 <= int(s) <= 12 for s in my_stars):
+        print(f"Error: Stars must be between 1 and 12, got {my_stars}")
+        exit(1)
 
     print(f"Checking Euromillions results...")
     print(f"Your numbers: {my_numbers}")
@@ -0,0 +1,68 @@
+"""Helpers shared by the Euromillions scripts."""
+import json
+import random
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+TELEGRAM_API = "https://api.telegram.org/bot{token}/sendMessage"
+# Upper bound for a server-requested retry_after, in seconds
+MAX_RETRY_AFTER = 60
+
+
+def https_request(method, url, body=None, headers=None):
+    """Send an HTTPS request and return the open response.
+
+    Like urlopen, redirects are followed and any other non-2xx status
+    (including 304 Not Modified) raises urllib.error.HTTPError.
+    """
+    req = urllib.request.Request(url, data=body, method=method, headers={
+        "User-Agent": "Mozilla/5.0",
+        **(headers or {})
+    })
+    return urllib.request.urlopen(req, timeout=30)
+
+
+def send_with_retry(req_fn, max_attempts=5):
+    """Call req_fn, retrying on rate limits, server errors and failed connections."""
+    for attempt in range(1, max_attempts + 1):
+        # Exponential backoff with jitter, unless Telegram says how long to wait
+        delay = 2 ** attempt + random.random()
+        try:
+            return req_fn()
+        except urllib.error.HTTPError as e:
+            if attempt == max_attempts or (e.code != 429 and e.code < 500):
+                raise
+            if e.code == 429:
+                try:
+                    delay = max(0, min(json.load(e)["parameters"]["retry_after"], MAX_RETRY_AFTER))
+                except (ValueError, KeyError, TypeError):
+                    pass
+            e.close()
+        except urllib.error.URLError:
+            # urlopen only raises URLError when connecting or sending fails, so the
+            # request never reached Telegram. Other errors, such as a read timeout,
+            # can happen after the message was delivered and are not retried.
+            if attempt == max_attempts:
+                raise
+
+        print(f"Telegram request failed, retrying in {delay:.1f}s ({attempt}/{max_attempts})...")
+        time.sleep(delay)
+
+
+def send_telegram_message(token, chat_id, message):
+    """Send a message via Telegram Bot API."""
+    url = TELEGRAM_API.format(token=token)
+    data = urllib.parse.urlencode({
+        "chat_id": chat_id,
+        "text": message,
+        "parse_mode": "Markdown"
+    }).encode("utf-8")
+
+    response = send_with_retry(
+        lambda: https_request("POST", url, body=data,
+                              headers={"Content-Type": "application/x-www-form-urlencoded"})
+    )
+    with response:
+        return json.load(response)
@@ -1,14 +1,43 @@
 #!/usr/bin/env python3
+import base64
 import imaplib
-import email
-import json
 import os
+import quopri
 import re
-import urllib.request
+import threading
+from datetime import datetime, timedelta, timezone
+
+from lottery_common import send_telegram_message
 
-TELEGRAM_API = "https://api.telegram.org/bot{token}/sendMessage"
 IMAP_SERVER = "imap.gmail.com"
 SENDER_EMAIL = "envios@loteriasyapuestas.es"
+SEARCH_WINDOW_DAYS = 14
+
+# IMAP BODYSTRUCTURE tokens: parentheses, quoted strings and atoms
+_BODYSTRUCTURE_TOKEN_RE = re.compile(rb'\(|\)|"((?:[^"\\]|\\.)*)"|([^\s()"]+)')
+_QUOTED_ESCAPE_RE = re.compile(rb'\\(.)')
+_LITERAL_SIZE_RE = re.compile(rb'\{\d+\}$')
+
+# Ticket fields in the lottery email HTML
+# Group 1 is the tag before the amount, or None for a plain-text balance
+_BALANCE_RE = re.compile(r'saldo actual es[:\s]*(<[^>]*>\s*)?([\d,]+)\s*€', re.IGNORECASE)
+# Numbers and stars appear in td elements with width:30px and text-align:center,
+# separated by a "+" td; group 1 is None for the separator
+_COUPON_CELL_RE = re.compile(
+    r'<td[^>]*style="[^"]*width:\s*30px[^"]*"[^>]*>\s*(\d{2})\s*</td>'
+    r'|<td[^>]*>\s*\+\s*</td>',
+    re.IGNORECASE | re.DOTALL
+)
+_SIMPLE_NUMBER_RE = re.compile(r'<td[^>]*>\s*(\d{2})\s*</td>', re.IGNORECASE | re.DOTALL)
+_MILLON_RE = re.compile(r'([A-Z]{3}\d{5})')
+_MILLON_DATE_RE = re.compile(
+    r'game_millon_ticket\.gif.*?<p[^>]*>\s*(\d{1,2}\s+[A-Z]{3}\s+\d{2}(?:\s*-\s*\d{1,2}\s+[A-Z]{3}\s+\d{2})?)\s*</p>',
+    re.DOTALL | re.IGNORECASE
+)
+_DRAW_DATE_RE = re.compile(r'(\d{1,2}\s+[A-Z]{3}\s+\d{4}(?:\s*-\s*\d{1,2}\s+[A-Z]{3}\s+\d{4})?)')
+_PRICE_RE = re.compile(r'([\d,]+)\s*EUR')
+_BET_RE = re.compile(r'(\d+)\s*apuesta', re.IGNORECASE)
+_REF_RE = re.compile(r'(\d{5}-\d{4}-\d{5}-\d{5}-\d{5}-\d{5}-\d{5})')
 
 
 def connect_to_gmail(email_address, app_password):
@@ -19,39 +48,111 @@ def connect_to_gmail(email_address, app_password):
 
 
 def fetch_latest_lottery_email(mail):
-    """Fetch the most recent email from the lottery sender."""
+    """Fetch the HTML part of the most recent email from the lottery sender.
+
+    Returns the raw part payload with its transfer encoding and charset.
+    """
     mail.select("inbox")
 
-    # Search for emails from the lottery sender
-    status, messages = mail.search(None, f'FROM "{SENDER_EMAIL}"')
+    # Search only recent emails from the lottery sender
+    since = (datetime.now(timezone.utc) - timedelta(days=SEARCH_WINDOW_DAYS)).strftime("%d-%b-%Y")
+    criteria = f'(FROM "{SENDER_EMAIL}" SINCE {since})'
+
+    if "SORT" in mail.capabilities:
+        # The server returns the newest email first
+        status, messages = mail.uid("SORT", "(REVERSE DATE)", "UTF-8", criteria)
+        latest_index = 0
+    else:
+        status, messages = mail.uid("SEARCH", None, criteria)
+        latest_index = -1
+
     if status != "OK" or not messages[0]:
-        raise Exception(f"No emails found from {SENDER_EMAIL}")
+        raise Exception(f"No emails found from {SENDER_EMAIL} in the last {SEARCH_WINDOW_DAYS} days")
 
     # Get the latest email
-    email_ids = messages[0].split()
-    latest_email_id = email_ids[-1]
+    email_uids = messages[0].split()
+    latest_email_uid = email_uids[latest_index]
 
-    status, msg_data = mail.fetch(latest_email_id, "(RFC822)")
+    status, msg_data = mail.uid("FETCH", latest_email_uid, "(BODYSTRUCTURE)")
     if status != "OK":
+        raise Exception("Failed to fetch email structure")
+
+    html_part = find_html_part(parse_bodystructure(msg_data))
+    if html_part is None:
+        raise Exception("No HTML content found in email")
+    section, encoding, charset = html_part
+
+    # Download only the HTML part; PEEK leaves the email unread
+    status, msg_data = mail.uid("FETCH", latest_email_uid, f"(BODY.PEEK[{section}])")
+    # The part only arrives as a (prefix, literal) tuple; an empty "" or NIL
+    # section comes back as plain bytes
+    if status != "OK" or not msg_data or not isinstance(msg_data[0], tuple):
         raise Exception("Failed to fetch email")
 
-    return email.message_from_bytes(msg_data[0][1])
-
-
-def get_email_html(msg):
-    """Extract HTML content from email."""
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            if content_type == "text/html":
-                charset = part.get_content_charset() or "utf-8"
-                return part.get_payload(decode=True).decode(charset)
-    else:
-        if msg.get_content_type() == "text/html":
-            charset = msg.get_content_charset() or "utf-8"
-            return msg.get_payload(decode=True).decode(charset)
-
-    raise Exception("No HTML content found in email")
+    return msg_data[0][1], encoding, charset
+
+
+def parse_bodystructure(msg_data):
+    """Parse a FETCH (BODYSTRUCTURE) response into nested lists of strings."""
+    # imaplib returns literals as (prefix, literal) tuples; inline them as quoted strings
+    raw = b""
+    for item in msg_data:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            literal = literal.replace(b"\\", b"\\\\").replace(b'"', b'\\"')
+            raw += _LITERAL_SIZE_RE.sub(b"", prefix) + b'"' + literal + b'"'
+        else:
+            raw += item
+
+    stack = [[]]
+    start = raw.index(b"BODYSTRUCTURE") + len(b"BODYSTRUCTURE")
+    for token in _BODYSTRUCTURE_TOKEN_RE.finditer(raw, start):
+        quoted, atom = token.groups()
+        if token.group() == b"(":
+            stack.append([])
+        elif token.group() == b")":
+            node = stack.pop()
+            stack[-1].append(node)
+            if len(stack) == 1:
+                break
+        elif quoted is not None:
+            stack[-1].append(_QUOTED_ESCAPE_RE.sub(rb"\1", quoted).decode(errors="replace"))
+        else:
+            stack[-1].append(None if atom.upper() == b"NIL" else atom.decode(errors="replace"))
+
+    return stack[0][0]
+
+
+def find_html_part(body, section=""):
+    """Find the first text/html part in a parsed BODYSTRUCTURE.
+
+    Returns (section, encoding, charset), or None if there is no HTML part.
+    """
+    if isinstance(body[0], list):
+        # Multipart: the child parts come first, followed by the subtype
+        for index, part in enumerate(body, 1):
+            if not isinstance(part, list):
+                break
+            found = find_html_part(part, f"{section}.{index}" if section else str(index))
+            if found:
+                return found
+        return None
+
+    if (body[0] or "").lower() == "text" and (body[1] or "").lower() == "html":
+        params = body[2] or []
+        charset = dict(zip((k.lower() for k in params[::2]), params[1::2])).get("charset")
+        return section or "1", (body[5] or "7bit").lower(), charset
+
+    return None
+
+
+def get_email_html(payload, encoding, charset):
+    """Decode the HTML part payload using its transfer encoding and charset."""
+    if encoding == "base64":
+        payload = base64.b64decode(payload)
+    elif encoding == "quoted-printable":
+        payload = quopri.decodestring(payload)
+    return payload.decode(charset or "utf-8")
 
 
 def extract_ticket_data(html_content):
@@ -68,41 +169,41 @@ def extract_ticket_data(html_content):
         "reference": None,
     }
 
-    # Extract balance
-    balance_match = re.search(r'saldo actual es[:\s]*<[^>]*>\s*([\d,]+)\s*€', html_content, re.IGNORECASE)
-    if balance_match:
-        data["balance"] = balance_match.group(1) + "€"
-    else:
-        balance_match = re.search(r'saldo actual es[:\s]*([\d,]+)\s*€', html_content, re.IGNORECASE)
-        if balance_match:
-            data["balance"] = balance_match.group(1) + "€"
-
-    # Extract numbers (5 main numbers) and stars (2)
-    # They appear in td elements with width:30px and text-align:center
-    # Use a flexible pattern that handles whitespace and newlines
-    number_pattern = re.compile(
-        r'<td[^>]*style="[^"]*width:\s*30px[^"]*"[^>]*>\s*(\d{2})\s*</td>',
-        re.IGNORECASE | re.DOTALL
-    )
-
-    # Find position of "+" separator to distinguish numbers from stars
-    plus_match = re.search(r'<td[^>]*>\s*\+\s*</td>', html_content, re.IGNORECASE | re.DOTALL)
-    if plus_match:
-        plus_pos = plus_match.start()
-        before_plus = html_content[:plus_pos]
-        after_plus = html_content[plus_pos:]
-
-        numbers_before = number_pattern.findall(before_plus)
-        numbers_after = number_pattern.findall(after_plus)
-
-        data["numbers"] = numbers_before[-5:] if len(numbers_before) >= 5 else numbers_before
-        data["stars"] = numbers_after[:2] if len(numbers_after) >= 2 else numbers_after
+    # Extract balance: a tagged amount wins over a plain-text one,
+    # otherwise the first plain-text amount is used
+    for balance_match in _BALANCE_RE.finditer(html_content):
+        tag, amount = balance_match.groups()
+        if tag is not None:
+            data["balance"] = amount + "€"
+            break
+        if data["balance"] is None:
+            data["balance"] = amount + "€"
+
+    # Extract numbers (5 main numbers) and stars (2) in a single scan,
+    # using the first "+" separator to distinguish numbers from stars
+    numbers_before = []
+    numbers_after = []
+    seen_plus = False
+    for cell in _COUPON_CELL_RE.finditer(html_content):
+        number = cell.group(1)
+        if number is None:
+            seen_plus = True
+        elif seen_plus:
+            numbers_after.append(number)
+            if len(numbers_after) == 2:
+                # Both stars found; the rest of the email doesn't matter
+                break
+        else:
+            numbers_before.append(number)
+
+    if seen_plus:
+        data["numbers"] = numbers_before[-5:]
+        data["stars"] = numbers_after[:2]
 
     # Fallback: try simpler pattern if no numbers found
     if not data["numbers"]:
         # Look for 2-digit numbers in td elements within the coupon area
-        simple_pattern = re.compile(r'<td[^>]*>\s*(\d{2})\s*</td>', re.IGNORECASE | re.DOTALL)
-        all_numbers = simple_pattern.findall(html_content)
+        all_numbers = _SIMPLE_NUMBER_RE.findall(html_content)
         # Filter to likely lottery numbers (01-50 for numbers, 01-12 for stars)
         lottery_numbers = [n for n in all_numbers if 1 <= int(n) <= 50]
         if len(lottery_numbers) >= 7:
@@ -110,39 +211,32 @@ def extract_ticket_data(html_content):
             data["stars"] = lottery_numbers[5:7]
 
     # Extract El Millón code (pattern: 3 letters + 5 digits)
-    millon_match = re.search(r'([A-Z]{3}\d{5})', html_content)
+    millon_match = _MILLON_RE.search(html_content)
     if millon_match:
         data["millon_code"] = millon_match.group(1)
 
     # Extract El Millón date (pattern like "23 ENE 26" or "27 ENE 26 - 30 ENE 26")
-    millon_date_match = re.search(
-        r'game_millon_ticket\.gif.*?<p[^>]*>\s*(\d{1,2}\s+[A-Z]{3}\s+\d{2}(?:\s*-\s*\d{1,2}\s+[A-Z]{3}\s+\d{2})?)\s*</p>',
-        html_content,
-        re.DOTALL | re.IGNORECASE
-    )
+    millon_date_match = _MILLON_DATE_RE.search(html_content)
     if millon_date_match:
         data["millon_date"] = millon_date_match.group(1)
 
     # Extract draw date (pattern like "23 ENE 2026" or "27 ENE 2026 - 30 ENE 2026")
-    draw_date_match = re.search(
-        r'(\d{1,2}\s+[A-Z]{3}\s+\d{4}(?:\s*-\s*\d{1,2}\s+[A-Z]{3}\s+\d{4})?)',
-        html_content
-    )
+    draw_date_match = _DRAW_DATE_RE.search(html_content)
     if draw_date_match:
         data["draw_date"] = draw_date_match.group(1)
 
     # Extract price
-    price_match = re.search(r'([\d,]+)\s*EUR', html_content)
+    price_match = _PRICE_RE.search(html_content)
     if price_match:
         data["price"] = price_match.group(1) + " EUR"
 
     # Extract bet count
-    bet_match = re.search(r'(\d+)\s*apuesta', html_content, re.IGNORECASE)
+    bet_match = _BET_RE.search(html_content)
     if bet_match:
         data["bet_count"] = bet_match.group(1)
 
     # Extract reference number
-    ref_match = re.search(r'(\d{5}-\d{4}-\d{5}-\d{5}-\d{5}-\d{5}-\d{5})', html_content)
+    ref_match = _REF_RE.search(html_content)
     if ref_match:
         data["reference"] = ref_match.group(1)
 
@@ -191,24 +285,6 @@ def format_ticket_message(data):
     return "\n".join(lines)
 
 
-def send_telegram_message(token, chat_id, message):
-    """Send a message via Telegram Bot API."""
-    url = TELEGRAM_API.format(token=token)
-    data = json.dumps({
-        "chat_id": chat_id,
-        "text": message,
-        "parse_mode": "Markdown"
-    }).encode("utf-8")
-
-    req = urllib.request.Request(url, data=data, headers={
-        "Content-Type": "application/json",
-        "User-Agent": "Mozilla/5.0"
-    })
-
-    with urllib.request.urlopen(req, timeout=30) as response:
-        return json.loads(response.read().decode())
-
-
 def main():
     # Get configuration from environment
     telegram_token = os.environ.get("TELEGRAM_BOT_TOKEN")
@@ -225,10 +301,14 @@ def main():
     mail = connect_to_gmail(gmail_address, gmail_app_password)
 
     print(f"Fetching latest email from {SENDER_EMAIL}...")
-    msg = fetch_latest_lottery_email(mail)
+    html_part = fetch_latest_lottery_email(mail)
+
+    # Nothing else needs the mailbox, so log out while the ticket is processed
+    logout = threading.Thread(target=mail.logout)
+    logout.start()
 
     print("Extracting email content...")
-    html_content = get_email_html(msg)
+    html_content = get_email_html(*html_part)
 
     # Extract ticket data
     print("Extracting ticket data...")
@@ -254,7 +334,7 @@ def main():
         print(f"Failed to send message: {result}")
         exit(1)
 
-    mail.logout()
+    logout.join()
 
 
 if __name__ == "__main__":